@@ -1,3 +1,3 @@
 # dynips package
 
-__all__ = ['lib','expire','managesgs']
+__all__ = ['lib','expire','managesgs','store']
@@ -1,7 +1,66 @@
 import boto3
+import logging
+import collections
+import itertools
+import time
 
 import lib
 
+logger = logging.getLogger()
+
+# Once a host's Route 53 change has gone through, a failed copy to its
+# EXPIRED file would leave it expired in the zone but still active in
+# the bucket, so the copy is retried a few times, with a growing delay,
+# before the host is left for the next run.
+#
+COPY_ATTEMPTS = 3
+COPY_RETRY_DELAY = 1  # seconds
+
+
+def findExpiredFiles(bucket, expiry_time):
+    '''
+    Find the hosts to expire by querying an indexed store for the
+    PING files last modified before expiry_time. Return a dict
+    mapping each host that is not held to the key of its PING file.
+    '''
+    held = set(f.item for f in bucket.iterStateFiles(ext=bucket.HOLD_EXT))
+
+    return dict(
+        (f.item, f.key)
+        for f in bucket.iterStateFiles(ext=bucket.PING_EXT, before=expiry_time)
+        if f.item not in held)
+
+
+def findExpiredInIndex(bucket, expiry_time):
+    '''
+    Find the hosts to expire from the due entries of the expiry index.
+    Return a dict mapping each host to the key of its PING file, and a
+    dict mapping each host with due entries to the keys of the entries.
+
+    The files remain the authority, so each candidate is checked
+    concurrently against its PING and HOLD files. A host that pinged
+    since its entry was written has a later entry, and a held host
+    gets a new entry when its hold is removed, so neither needs the
+    due entry any more.
+    '''
+    entries = collections.defaultdict(list)
+
+    for key, host in bucket.iterExpiryIndex(lib.toEpoch(expiry_time)):
+        entries[host].append(key)
+
+    def check(host):
+        ping_key = lib.getStateFilename(host, bucket.PING_EXT)
+        last_modified = bucket.getLastModified(ping_key)
+
+        if last_modified is None or last_modified >= expiry_time or \
+                bucket.getLastModified(
+                    lib.getStateFilename(host, bucket.HOLD_EXT)) is not None:
+            return None
+
+        return (host, ping_key)
+
+    return dict(r for r in lib.iterParallel(check, entries) if r), entries
+
 
 def expireHosts(session=None, max_age=None):
     '''
@@ -14,23 +73,99 @@ def expireHosts(session=None, max_age=None):
     with a HOLD extension. To expire a host, we
     delete the PING file and replace it with an
     EXPIRED file.
-    '''
-    bucket = lib.S3Bucket(session)
 
-    holds = set(f.host for f in bucket.iterStateFiles(ext=bucket.HOLD_EXT))
+    The route 53 updates are submitted in batches. A host
+    is marked expired only if its batch was accepted. The
+    EXPIRED files are server-side copies of the PING files,
+    made concurrently, and the PING files are then deleted
+    in bulk. A copy is retried a few times. A host whose copy
+    still fails keeps its PING file and its index entries, and
+    the next run expires it again, which repeats the Route 53
+    change harmlessly.
+
+    The candidates for expiry are taken from the due entries of
+    the expiry index, which is created on the first run. The due
+    entries are deleted, except those of hosts that failed to
+    expire, which are retried by the next run. An indexed store
+    is queried directly and needs no expiry index.
+
+    If there is a state manifest, and it is at least
+    MANIFEST_REFRESH_INTERVAL old, it is refreshed at the end of
+    the run. This is the only regular update it gets.
+    '''
+    bucket = lib.S3Bucket(session, preload=False)
     expiry_time = lib.getExpiryTime(max_age)
+
+    if bucket.store.indexed:
+        with lib.timeStage('find_expired'):
+            to_expire, entries = findExpiredFiles(bucket, expiry_time), {}
+
+    else:
+        if not bucket.hasExpiryIndex():
+            with lib.timeStage('build_index'):
+                logger.info('Created the expiry index with {} entries'.format(
+                    bucket.rebuildExpiryIndex()))
+
+        with lib.timeStage('find_expired'):
+            to_expire, entries = findExpiredInIndex(bucket, expiry_time)
+
+    def markExpired(host):
+        for attempt in range(1, COPY_ATTEMPTS + 1):
+            try:
+                bucket.copyStateFile(
+                    to_expire[host], host, bucket.EXPIRED_EXT)
+                return host
+            except Exception as e:
+                if attempt < COPY_ATTEMPTS:
+                    time.sleep(COPY_RETRY_DELAY * attempt)
+                else:
+                    logger.error(
+                        'Failed to mark {} expired after {} attempts, '
+                        'leaving it for the next run: {}'.format(
+                            host, attempt, e))
+
+        return None
+
     expired = []
 
-    for f in (x for x in bucket.iterStateFiles(ext=bucket.PING_EXT)
-              if x.file.last_modified < expiry_time and x.host not in holds):
+    batches = bucket.setHostIPs((host, None) for host in to_expire)
+
+    while True:
+        with lib.timeStage('route53'):
+            batch = next(batches, None)
+
+        if batch is None:
+            break
+
+        hosts, ok, result = batch
 
-        bucket.setHostIP(f.host, None)
-        bucket.writeStateFile(
-            f.host, bucket.EXPIRED_EXT, f.file.get()['Body'].read())
-        f.file.delete()
-        expired.append(f.host)
+        if not ok:
+            logger.error(
+                'Failed to expire {}: {}'.format(', '.join(hosts), result))
+            continue
+
+        with lib.timeStage('mark_expired'):
+            expired.extend(
+                h for h in lib.iterParallel(markExpired, hosts) if h)
+
+    failed = set(to_expire).difference(expired)
+
+    with lib.timeStage('delete_pings'):
+        for key, msg in bucket.deleteKeys(itertools.chain(
+                (to_expire[h] for h in expired),
+                itertools.chain.from_iterable(
+                    keys for h, keys in entries.iteritems()
+                    if h not in failed))):
+            logger.error('Failed to delete {}: {}'.format(key, msg))
 
     if expired:
-        lib.kickManager(bucket.session)
+        with lib.timeStage('kick_manager'):
+            lib.kickManager(bucket)
+
+    with lib.timeStage('manifest'):
+        try:
+            bucket.refreshManifest(lib.MANIFEST_REFRESH_INTERVAL)
+        except Exception as e:
+            logger.error('Failed to refresh the manifest: {}'.format(e))
 
     return expired
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
 import logging
+import boto3
 import dynips.expire
+from dynips.lib import startMetrics, instrumentSession
 
 
 def lambda_handler(event, context):
@@ -14,18 +16,21 @@ def lambda_handler(event, context):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    try:
-        result = dynips.expire.expireHosts()
+    metrics = startMetrics('expirer')
+    result = []
+    ok = False
 
-        if not result:
-            result.append('Nothing')
+    try:
+        result = dynips.expire.expireHosts(instrumentSession(boto3.Session()))
+        ok = True
 
-        for h in result:
+        for h in result or ['Nothing']:
             logger.info('Expired: {}'.format(h))
 
     except:
         logging.exception( 'Woops')
 
+    metrics.emit(ok=ok, expired=len(result))
     return {}
 
 
@@ -1,16 +1,123 @@
 import boto3
 import json
+import os
 import re
 import collections
+import calendar
+import random
+import itertools
 import datetime
+import time
+import threading
+import Queue
+import logging
+import contextlib
 import pytz
+from botocore.exceptions import ClientError
 
 from params import Params
+from store import S3Store, SQLiteStore
 
 
 USERS_FOLDER = 'users/'
 STATE_FOLDER = 'state/'
 
+# The expiry index schedules each ping for expiry checking. An entry
+# expiry/<start>/<host> is written with each .ping file, where <start>
+# is the start of the EXPIRY_BUCKET_SECONDS time bucket after the one
+# of the write, zero-padded so that the keys list in time order. The
+# .ping file records the key of its entry, and the entry of the .ping
+# file it replaces is deleted, so the index holds about one entry per
+# host. The expirer lists only the buckets that are entirely older
+# than the expiry time. It creates the index from the .ping files on
+# its first run, and then writes EXPIRY_INDEX_MARKER, which sorts
+# after all of the buckets.
+#
+EXPIRY_FOLDER = 'expiry/'
+EXPIRY_BUCKET_SECONDS = 60
+EXPIRY_INDEX_MARKER = EXPIRY_FOLDER + '_created'
+EXPIRY_ENTRY_RE = re.compile(
+    EXPIRY_FOLDER + '(?P<start>[0-9]{10})/(?P<host>[a-z0-9-]+)$')
+
+# The state manifest summarizes all hosts and locks in one object.
+# It is a snapshot, and is kept off the server's path. A refresh lists
+# all of the state files, so the expirer refreshes it only once it is
+# MANIFEST_REFRESH_INTERVAL old. The leading underscore keeps it from
+# matching STATE_FILE_RE.
+#
+MANIFEST_KEY = STATE_FOLDER + '_manifest.json'
+MANIFEST_REFRESH_INTERVAL = 3600  # seconds
+
+# Changes that need the manager are coalesced by a pending-change
+# marker. The first change of a burst creates the marker and publishes
+# to SNS; later changes find the marker and do not publish. The manager
+# waits until the marker is MANAGER_COALESCE_WINDOW seconds old, then
+# deletes it and applies all of the changes made so far. The window is
+# short because the manager lambda has a short timeout.
+#
+PENDING_KEY = STATE_FOLDER + '_pending.json'
+MANAGER_COALESCE_WINDOW = 1  # seconds
+
+# A marker older than this is assumed to be left over from a failed
+# manager run, and is replaced by the next change, which publishes.
+#
+PENDING_MAX_AGE = 300  # seconds
+
+# How long a failed request counts towards locking a user or IP
+#
+FAILURE_WINDOW = 24 * 3600  # seconds
+
+# Each failure is recorded in its own .failures.<ord> file, so that
+# concurrent failures never overwrite each other. The ordinal is the
+# time of the failure times FAILURE_ORD_SCALE, plus a random part
+# that keeps failures in the same second apart.
+#
+FAILURE_ORD_SCALE = 1000000
+
+# How long to remember a hostname's IP in-process. An entry can be
+# this much out of date, for instance after an expiry made by another
+# process, so only the lookups that just report an IP use the cache.
+# A ping that may change the IP always reads the current one.
+#
+HOST_IP_CACHE_TTL = 60  # seconds
+
+host_ip_cache = {}
+
+# Route 53 allows at most 1000 resource records per change batch, and
+# counts each UPSERT twice. This also keeps a batch far below the limit
+# on the total length of record values.
+#
+ROUTE53_MAX_CHANGES = 400
+
+# The default number of threads for concurrent S3 requests
+#
+MAX_WORKERS = 16
+
+# Where the user and state files are kept: 's3' for Params.S3_BUCKET,
+# or 'sqlite:<path>' for an SQLite database. The DYNIPS_STORE
+# environment variable overrides this.
+#
+DEFAULT_STORE = 's3'
+
+# The fraction of lambda invocations that log a metrics line. The
+# DYNIPS_METRICS_SAMPLE_RATE environment variable overrides this.
+#
+METRICS_SAMPLE_RATE = 1.0
+
+# The Metrics of the current lambda invocation, or None
+#
+current_metrics = None
+
+# A ping that changes neither the IP nor the hold state rewrites the
+# .ping file only once the file is older than this fraction of MAX_AGE.
+# The expirer may then see a .ping file up to this much older than the
+# latest ping, so it allows that much more age before expiring a host,
+# and a client that pings within MAX_AGE is never expired. The
+# DYNIPS_PING_REFRESH_FRACTION environment variable overrides this,
+# and must be the same for the server and the expirer.
+#
+PING_REFRESH_FRACTION = 0.25
+
 
 def getStateFilename(basename, ext, ord=None):
     name = ''.join((STATE_FOLDER, basename.lower(), '.', ext))
@@ -23,10 +130,35 @@ def getUserFilename(user):
     return ''.join((USERS_FOLDER, user.lower()))
 
 
+def getPingRefreshFraction():
+    return float(os.environ.get(
+        'DYNIPS_PING_REFRESH_FRACTION', PING_REFRESH_FRACTION))
+
+
 def getExpiryTime(max_age=None):
+    '''
+    Return the time before which a .ping file is expired. This allows
+    for the pings that were not written, because the file was fresh.
+    See PING_REFRESH_FRACTION.
+    '''
     return datetime.datetime.now(pytz.UTC) - \
         datetime.timedelta(
-            seconds=Params.MAX_AGE if max_age is None else max_age)
+            seconds=(Params.MAX_AGE if max_age is None else max_age) +
+            getPingRefreshFraction() * Params.MAX_AGE)
+
+
+def getExpiryEntryKey(host, when):
+    '''
+    Return the key of the expiry index entry for a ping of the
+    specified host at when, in seconds since the epoch.
+    '''
+    start = int(when) // EXPIRY_BUCKET_SECONDS * EXPIRY_BUCKET_SECONDS
+    return '{}{:010d}/{}'.format(EXPIRY_FOLDER, start, host.lower())
+
+
+def toEpoch(dt):
+    '''Convert a timezone-aware datetime to seconds since the epoch'''
+    return calendar.timegm(dt.utctimetuple())
 
 
 def getFullHostname(host):
@@ -37,45 +169,311 @@ def getMaxErrors():
     return Params.MAX_ERRORS
 
 
+def cacheHostIP(host, ip):
+    host_ip_cache[host.lower()] = (ip, time.time() + HOST_IP_CACHE_TTL)
+
+
 def argToTuple(arg):
     if arg is None:
         return ()
-    elif isinstance(arg, str):
+    elif isinstance(arg, basestring):
         return (arg,)
     else:
         return tuple(arg)
 
 
-def kickManager(session):
-    if Params.DO_SNS:
-        session.client('sns').publish(
+def iterParallel(func, items, max_workers=MAX_WORKERS):
+    '''
+    A generator that calls func for each of items on a bounded pool
+    of threads, and returns the results in the order they complete.
+    If a call raises an exception, the generator raises it too.
+
+    boto3 clients are thread-safe, but sessions and resources are not,
+    so func should use clients created beforehand.
+    '''
+    items = list(items)
+    if not items:
+        return
+
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    for item in items:
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                done.put((True, func(item)))
+            except Exception as e:
+                done.put((False, e))
+
+    for i in range(min(max_workers, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for i in range(len(items)):
+        ok, result = done.get()
+        if not ok:
+            raise result
+        yield result
+
+
+def kickManager(bucket):
+    '''
+    Ask the manager to update the security groups,
+    unless a request is already pending. If the marker
+    cannot be written, publish anyway.
+    '''
+    if not Params.DO_SNS:
+        return
+
+    try:
+        pending = bucket.markPending()
+    except Exception as e:
+        logging.getLogger().warning(
+            'Failed to write the pending-change marker: {}'.format(e))
+        pending = True
+
+    if pending:
+        bucket.getClient('sns').publish(
             TopicArn=Params.SNS_ARN,
             Message='{"Event":"Change"}',
             )
 
 
+class Metrics(object):
+    '''
+    The metrics of one lambda invocation: the time spent in each named
+    stage, and the count and total latency of each AWS API call. The
+    API calls are recorded by botocore event hooks on the sessions
+    passed to instrumentSession().
+    '''
+    def __init__(self, handler, sample_rate=None):
+        if sample_rate is None:
+            sample_rate = float(os.environ.get(
+                'DYNIPS_METRICS_SAMPLE_RATE', METRICS_SAMPLE_RATE))
+
+        self.handler = handler
+        self.sampled = random.random() < sample_rate
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+
+    def addStage(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def addCall(self, name, seconds):
+        with self.lock:
+            count, total = self.calls.get(name, (0, 0))
+            self.calls[name] = (count + 1, total + seconds)
+
+    def emit(self, **fields):
+        '''
+        If this invocation was sampled, log the metrics as
+        one line of JSON, with any additional fields.
+        '''
+        if not self.sampled:
+            return
+
+        def ms(seconds):
+            return round(seconds * 1000, 1)
+
+        record = {
+            'handler': self.handler,
+            'duration_ms': ms(time.time() - self.start),
+            'stages_ms': dict(
+                (name, ms(s)) for name, s in self.stages.iteritems()),
+            'api_calls': dict(
+                (name, {'count': count, 'ms': ms(total)})
+                for name, (count, total) in self.calls.iteritems()),
+        }
+        record.update(fields)
+
+        logging.getLogger().info('METRICS {}'.format(
+            json.dumps(record, sort_keys=True, separators=(',', ':'))))
+
+
+def startMetrics(handler, sample_rate=None):
+    '''Start the Metrics of a lambda invocation, and return them'''
+    global current_metrics
+    current_metrics = Metrics(handler, sample_rate)
+    return current_metrics
+
+
+@contextlib.contextmanager
+def timeStage(name):
+    '''
+    Add the time spent in the block to the named stage of the current
+    invocation's metrics. Stages may be entered more than once.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics = current_metrics
+        if metrics is not None:
+            metrics.addStage(name, time.time() - start)
+
+
+def beforeCall(context, **kwargs):
+    context['dynips_start'] = time.time()
+
+
+def afterCall(event_name, context, **kwargs):
+    metrics = current_metrics
+    start = context.get('dynips_start')
+
+    if metrics is not None and start is not None:
+        # The event name is after-call.<service>.<operation>
+        #
+        metrics.addCall(event_name.split('.', 1)[1], time.time() - start)
+
+
+def instrumentSession(session):
+    '''
+    Register the botocore hooks that record API calls in the current
+    invocation's metrics. Only clients and resources created from the
+    session afterwards are instrumented. Registering twice is harmless.
+    '''
+    session.events.register(
+        'before-call', beforeCall, unique_id='dynips-before-call')
+    session.events.register(
+        'after-call', afterCall, unique_id='dynips-after-call')
+    return session
+
+
+STATE_FILE_RE = re.compile(
+    STATE_FOLDER +
+    '(?P<item>(?P<host>'
+    '(?P<user>[a-zA-Z0-9]+)(?:-(?P<sub>[a-zA-Z0-9]+))?)|'
+    '(?P<ip>[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+))'
+    '\.(?P<ext>[a-z]+)(?:\.(?P<ord>[0-9]+))?$')
+
+USER_FILE_RE = re.compile(USERS_FOLDER + '([a-zA-Z0-9]+)')
+
+
 '''
 The tuple returned by S3Bucket.iterStateFiles()
 
-file: The S3 ObjectSummary for the file
+bucket: The store holding the file
+key:  The key of the file
+last_modified: The last-modified time of the file
 item: The base filename
 host: If the file references a hostname, the name
 user: If the file references a hostname, the user portion
 sub:  If the file references a hostname, the option part
 ip:   If the file references an IP, the IP
 ord:  If the extension is followed by an integer ordinal, the value
+file: (property) An S3 Object, or equivalent, for the file
 '''
-StateFile = collections.namedtuple(
-    'StateFile', 'file item host user sub ip ext ord')
+class StateFile(collections.namedtuple(
+        'StateFile',
+        'bucket key last_modified item host user sub ip ext ord')):
+    __slots__ = ()
+
+    @property
+    def file(self):
+        return self.bucket.Object(self.key)
+
+
+'''
+The tuple returned by S3Bucket.readPing()
+
+ip: The IP recorded in the .ping file
+hold: Whether the host was held, or None if the file does not say
+last_modified: The last-modified time of the file
+entry: The key of the file's expiry index entry, or None if the
+       file does not say
+'''
+Ping = collections.namedtuple('Ping', 'ip hold last_modified entry')
+
 
 '''
 The tuple returned by S3Bucket.iterUserFiles()
 
-file: The S3 ObjectSummary for the file
+bucket: The store holding the file
+key:  The key of the file
+last_modified: The last-modified time of the file
 user: The username
+file: (property) An S3 Object, or equivalent, for the file
 '''
-UserFile = collections.namedtuple(
-    'UserFile', 'file user')
+class UserFile(collections.namedtuple(
+        'UserFile', 'bucket key last_modified user')):
+    __slots__ = ()
+
+    @property
+    def file(self):
+        return self.bucket.Object(self.key)
+
+
+def parseKey(bucket, key, last_modified):
+    '''
+    Parse an S3 key into a StateFile or UserFile tuple.
+    Return None if the key is neither.
+    '''
+    match = STATE_FILE_RE.match(key)
+    if match:
+        ord = match.group('ord')
+        return StateFile(
+            bucket=bucket,
+            key=key,
+            last_modified=last_modified,
+            item=match.group('item'),
+            host=match.group('host'),
+            user=match.group('user'),
+            sub=match.group('sub'),
+            ip=match.group('ip'),
+            ext=match.group('ext'),
+            ord=int(ord) if ord else None)
+
+    match = USER_FILE_RE.match(key)
+    if match:
+        return UserFile(
+            bucket=bucket,
+            key=key,
+            last_modified=last_modified,
+            user=match.group(1))
+
+    return None
+
+
+def indexKey(key):
+    '''
+    Return the (item, ext, user) of a key, for the indexes of an
+    indexed store. Each is None if it does not apply.
+    '''
+    f = parseKey(None, key, None)
+
+    if isinstance(f, StateFile):
+        return (f.item, f.ext, f.user)
+    elif isinstance(f, UserFile):
+        return (None, None, f.user.lower())
+    else:
+        return (None, None, None)
+
+
+def openStore(session, url=None):
+    '''
+    Return the store named by url, by default
+    DYNIPS_STORE or DEFAULT_STORE.
+    '''
+    url = url or os.environ.get('DYNIPS_STORE', DEFAULT_STORE)
+
+    if url == 's3':
+        return S3Store(session, Params.S3_BUCKET, iterParallel)
+    elif url.startswith('sqlite:'):
+        return SQLiteStore(url[len('sqlite:'):], indexKey)
+    else:
+        raise ValueError("Unknown store '{}'".format(url))
 
 
 class S3Bucket():
@@ -83,20 +481,78 @@ class S3Bucket():
     HOLD_EXT = 'hold'
     EXPIRED_EXT = 'expired'
     ERROR_EXT = 'error'
+    FAILURES_EXT = 'failures'
     LOCK_EXT = 'lock'
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, preload=True, store=None):
+        '''
+        If preload, list the state and users folders up front. Otherwise,
+        look up files on demand with prefix-scoped listings, and
+        list them in full only when a full scan is needed.
+
+        The files are kept in store, by default the one returned by
+        openStore(). An indexed store is queried, never preloaded.
+        The session is used for the AWS services other than S3.
+        '''
 
         if session:
             self.session = session
         else:
             self.session =  boto3.Session()
 
-        self.s3 = self.session.resource("s3")
-        self.bucket = self.s3.Bucket(Params.S3_BUCKET)
-        self.files = {f.key: f for f in self.bucket.objects.all()}
+        self.store = store or openStore(self.session)
+        self.clients = {}
+        self.files = None
+
+        if preload and not self.store.indexed:
+            self.loadFiles()
+
+    def getClient(self, service):
+        '''
+        Return a client for the specified AWS service, created
+        from the bucket's session on first use and then reused.
+        '''
+        client = self.clients.get(service)
+        if client is None:
+            client = self.clients[service] = self.session.client(service)
+        return client
+
+    def listFiles(self, prefix=None):
+        '''
+        A generator to list the bucket, optionally limited to keys
+        that start with prefix. Return a StateFile or UserFile tuple
+        for each recognized key.
+        '''
+        for key, last_modified in self.store.list(prefix):
+            f = parseKey(self.store, key, last_modified)
+            if f is not None:
+                yield f
 
-    def iterStateFiles(self, base=None, ext=None):
+    def loadFiles(self):
+        '''
+        List the state and users folders, and index the state
+        files by item, extension and user. The rest of the bucket,
+        such as the expiry index, is not listed.
+        '''
+        self.files = {}
+        self.state_by_item = collections.defaultdict(list)
+        self.state_by_ext = collections.defaultdict(list)
+        self.state_by_user = collections.defaultdict(list)
+        self.user_files = []
+
+        for f in itertools.chain(
+                self.listFiles(STATE_FOLDER), self.listFiles(USERS_FOLDER)):
+            self.files[f.key] = f
+
+            if isinstance(f, StateFile):
+                self.state_by_item[f.item].append(f)
+                self.state_by_ext[f.ext].append(f)
+                if f.user:
+                    self.state_by_user[f.user].append(f)
+            else:
+                self.user_files.append(f)
+
+    def iterStateFiles(self, base=None, ext=None, user=None, before=None):
         '''
         A generator to iterate the state files.
 
@@ -109,63 +565,421 @@ class S3Bucket():
             specifying which filename extensions(s) to
             include
 
+        user
+            is an optional username. If specified, include
+            only hostname files belonging to the user.
+
+        before
+            is an optional datetime. If specified, include
+            only files last modified before it.
+
         The generator returns a StateFile namedtuple
         '''
-        base = argToTuple(base)
+        base = tuple(b.lower() for b in argToTuple(base))
         ext = argToTuple(ext)
+        user = user.lower() if user else None
 
-        for k, f in self.files.iteritems():
-            match = re.match(
-                STATE_FOLDER +
-                '(?P<item>(?P<host>'
-                '(?P<user>[a-zA-Z0-9]+)(?:-(?P<sub>[a-zA-Z0-9]+))?)|'
-                '(?P<ip>[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+))'
-                '\.(?P<ext>[a-z]+)(?:\.(?P<ord>[0-9]+))?$',
-                k)
-
-            if match and \
-                    (not base or match.group('item') in base) and \
-                    (not ext or match.group('ext') in ext):
-                yield StateFile(
-                    file=f,
-                    item=match.group('item'),
-                    host=match.group('host'),
-                    user=match.group('user'),
-                    sub=match.group('sub'),
-                    ip=match.group('ip'),
-                    ext=match.group('ext'),
-                    ord=int(match.group('ord')) if match.group('ord') else None)
+        if self.store.indexed:
+            files = (
+                parseKey(self.store, key, last_modified)
+                for key, last_modified in self.store.queryState(
+                    base, ext, user, before))
 
-    def iterUserFiles(self):
-        '''
-        A generator to iterate the state files.
+        elif self.files is None and (base or user):
+            if base:
+                files = itertools.chain.from_iterable(
+                    self.listFiles(STATE_FOLDER + b + '.') for b in base)
+            else:
+                files = self.listFiles(STATE_FOLDER + user)
 
-        base
-            is an optional string or iterable of strings
-            specifying which base filename(s) to include
+        else:
+            if self.files is None:
+                self.loadFiles()
 
-        ext
-            is an optional string or iterable of strings
-            specifying which filename extensions(s) to
-            include
+            if base:
+                files = itertools.chain.from_iterable(
+                    self.state_by_item.get(b, ()) for b in base)
+            elif user:
+                files = self.state_by_user.get(user, ())
+            elif ext:
+                files = itertools.chain.from_iterable(
+                    self.state_by_ext.get(e, ()) for e in ext)
+            else:
+                files = itertools.chain.from_iterable(
+                    self.state_by_ext.itervalues())
+
+        for f in files:
+            if isinstance(f, StateFile) and \
+                    (not base or f.item in base) and \
+                    (not ext or f.ext in ext) and \
+                    (not user or f.user == user) and \
+                    (before is None or f.last_modified < before):
+                yield f
+
+    def iterUserFiles(self):
+        '''
+        A generator to iterate the user files. If the bucket has not
+        been loaded, only the users folder is listed.
 
         The generator returns a UserFile namedtuple
         '''
-        for k, f in self.files.iteritems():
-            match = re.match(USERS_FOLDER + '([a-zA-Z0-9]+)', k)
-            if match:
-                yield UserFile(file=f, user=match.group(1))
+        if self.store.indexed:
+            return (
+                parseKey(self.store, key, last_modified)
+                for key, last_modified in self.store.queryUsers())
+
+        if self.files is None:
+            return (
+                f for f in self.listFiles(USERS_FOLDER)
+                if isinstance(f, UserFile))
+
+        return iter(self.user_files)
 
     def getFile(self, filename):
-        '''Return the S3 ObjectSummary for the specified file, or None'''
-        return self.files.get(filename)
+        '''
+        Return an S3 Object, or the store's equivalent,
+        for the specified file, or None
+        '''
+        if self.files is not None:
+            f = self.files.get(filename)
+            return f.file if f else None
+
+        if self.store.head(filename) is None:
+            return None
+
+        return self.store.Object(filename)
+
+    def hasFile(self, key):
+        '''
+        Return True if the file with the specified key exists. Unlike
+        getFile(), this is safe to call from multiple threads.
+        '''
+        if self.files is not None:
+            return key in self.files
+
+        return self.store.head(key) is not None
+
+    def readFile(self, key):
+        '''
+        Return the JSON content of the file with the specified key,
+        or None if there is no such file. Unlike the file property of
+        a StateFile, this is safe to call from multiple threads.
+        '''
+        found = self.store.get(key)
+        return json.loads(found[0]) if found else None
+
+    def getLastModified(self, key):
+        '''
+        Return the last-modified time of the file with the specified
+        key, or None if there is no such file. This is safe to call
+        from multiple threads.
+        '''
+        found = self.store.head(key)
+        return found[1] if found else None
+
+    def copyStateFile(self, key, name, ext):
+        '''
+        Copy the file with the specified key to a new state file,
+        without downloading it.
+        '''
+        self.store.copy(key, getStateFilename(name, ext))
+
+    def deleteKeys(self, keys, progress=None):
+        '''
+        Delete the files with the specified keys, in batches where the
+        store supports them. Return a list of (key, message) tuples for
+        the keys that could not be deleted. If given, progress(done,
+        total) is called as the batches complete.
+        '''
+        return self.store.deleteMany(keys, progress)
+
+    def markPending(self):
+        '''
+        Create the pending-change marker. Return True if the manager
+        needs to be asked to run, because there was no marker, or
+        the marker was stale.
+
+        S3 has no create-if-absent write that the supported SDK can
+        make, so the marker is checked and then written. Changes that
+        race past the check each publish, which costs an extra manager
+        run but loses no change.
+        '''
+        last_modified = self.getLastModified(PENDING_KEY)
+
+        if last_modified is not None and \
+                toEpoch(last_modified) > time.time() - PENDING_MAX_AGE:
+            return False
+
+        self.store.put(PENDING_KEY, json.dumps({'since': int(time.time())}))
+        return True
+
+    def takePending(self, window=MANAGER_COALESCE_WINDOW):
+        '''
+        If there is a pending-change marker, wait until it is window
+        seconds old, so that the changes of a burst are applied by one
+        manager run, then delete it and return True. Return False if
+        there is no marker.
+
+        The marker is deleted before the manager reads any state, so
+        a change made after it is deleted creates a new marker.
+        '''
+        last_modified = self.getLastModified(PENDING_KEY)
+        if last_modified is None:
+            return False
+
+        delay = toEpoch(last_modified) + window - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        self.store.delete(PENDING_KEY)
+        return True
+
+    def getManifest(self):
+        '''
+        Return the state manifest, or None if there is none.
+
+        The manifest is a dict:
+
+        hosts: Maps each hostname to a dict with the items
+               ip:        The hostname's IP
+               state:     'active', 'hold' or 'expired'
+               last_ping: The time of the last ping, in epoch seconds
+        locks: Maps each locked user or IP to a dict with the items
+               reason:    The lock reason
+               time:      The time of the lock, in epoch seconds
+        '''
+        return self.readFile(MANIFEST_KEY)
+
+    def updateManifest(self, update):
+        '''
+        Apply update, a function that modifies a manifest dict in place,
+        to the state manifest. This is for infrequent changes, such as
+        locks and admin commands. An update that races with another
+        write may be lost, and is then restored by the next
+        refreshManifest().
+
+        Do nothing if there is no manifest, because a manifest built
+        only from incremental updates would be incomplete. Use
+        rebuildManifest() to create one.
+
+        Return True if the manifest was updated. A failure is logged
+        rather than raised, because the state files have already
+        been changed.
+        '''
+        try:
+            manifest = self.getManifest()
+            if manifest is None:
+                return False
+
+            update(manifest)
+            self.store.put(
+                MANIFEST_KEY, json.dumps(manifest, separators=(',', ':')))
+            return True
+
+        except Exception as e:
+            logging.getLogger().error(
+                'Failed to update the manifest: {}'.format(e))
+            return False
+
+    def buildManifest(self, previous=None):
+        '''
+        Build a state manifest from the individual state files,
+        reading the IPs and lock reasons concurrently. If previous is
+        given, it is an earlier manifest, whose IPs and lock reasons
+        are reused for the files that have not changed since.
+        '''
+        previous = previous or {'hosts': {}, 'locks': {}}
+        hosts = {}
+        ip_files = []
+
+        for f in self.iterStateFiles(
+                ext=[self.PING_EXT, self.HOLD_EXT, self.EXPIRED_EXT]):
+
+            host = hosts.setdefault(
+                f.host, {'ip': None, 'state': 'active', 'last_ping': None})
+
+            if f.ext == self.HOLD_EXT:
+                host['state'] = 'hold'
+            else:
+                host['last_ping'] = toEpoch(f.last_modified)
+                ip_files.append(f)
+
+                if f.ext == self.EXPIRED_EXT:
+                    host['state'] = 'expired'
+
+        def readIP(f):
+            try:
+                return (f.host, self.readFile(f.key)['ip'])
+            except Exception:
+                return (f.host, None)
+
+        to_read = []
+
+        for f in ip_files:
+            old = previous['hosts'].get(f.host)
+
+            if old and old.get('ip') and \
+                    old['last_ping'] == hosts[f.host]['last_ping']:
+                hosts[f.host]['ip'] = old['ip']
+            else:
+                to_read.append(f)
+
+        for host, ip in iterParallel(readIP, to_read):
+            hosts[host]['ip'] = ip
+
+        def readReason(f):
+            try:
+                return (f.item, self.readFile(f.key)['error'])
+            except Exception:
+                return (f.item, 'Unknown')
+
+        locks = {}
+        to_read = []
+
+        for f in self.iterStateFiles(ext=self.LOCK_EXT):
+            old = previous['locks'].get(f.item)
+            locks[f.item] = {'reason': None, 'time': toEpoch(f.last_modified)}
+
+            # Older manifests map each lock to just its reason.
+            if isinstance(old, dict) and \
+                    old['time'] == locks[f.item]['time']:
+                locks[f.item]['reason'] = old['reason']
+            else:
+                to_read.append(f)
+
+        for item, reason in iterParallel(readReason, to_read):
+            locks[item]['reason'] = reason
+
+        return {'hosts': hosts, 'locks': locks}
+
+    def rebuildManifest(self):
+        '''
+        Regenerate the state manifest from the individual state files.
+        Return the new manifest.
+        '''
+        manifest = self.buildManifest()
+
+        self.store.put(
+            MANIFEST_KEY, json.dumps(manifest, separators=(',', ':')))
+
+        return manifest
+
+    def refreshManifest(self, interval=None):
+        '''
+        Bring the state manifest up to date with the state files, if
+        there is a manifest. This lists the state files, but reads only
+        those that changed since the manifest was written. If interval
+        is given, refresh only a manifest at least interval seconds old,
+        which costs one HEAD otherwise. Return the new manifest, or None
+        if there is none, or it was not refreshed.
+        '''
+        if interval is not None:
+            last_modified = self.getLastModified(MANIFEST_KEY)
+            if last_modified is None or \
+                    toEpoch(last_modified) > time.time() - interval:
+                return None
+
+        previous = self.getManifest()
+        if previous is None:
+            return None
+
+        manifest = self.buildManifest(previous)
+
+        self.store.put(
+            MANIFEST_KEY, json.dumps(manifest, separators=(',', ':')))
+
+        return manifest
+
+    def writeExpiryEntry(self, host, when):
+        '''
+        Write the expiry index entry for a ping of the specified host
+        at when, in seconds since the epoch.
+        '''
+        self.store.put(getExpiryEntryKey(host, when), '')
+
+    def hasExpiryIndex(self):
+        return self.hasFile(EXPIRY_INDEX_MARKER)
+
+    def rebuildExpiryIndex(self):
+        '''
+        Write an expiry index entry for each .ping file, concurrently,
+        and then the index marker. Entries already present are simply
+        rewritten.
+        '''
+        pings = [
+            (f.host, toEpoch(f.last_modified))
+            for f in self.iterStateFiles(ext=self.PING_EXT)]
+
+        for _ in iterParallel(
+                lambda ping: self.writeExpiryEntry(*ping), pings):
+            pass
+
+        self.store.put(EXPIRY_INDEX_MARKER, '')
+
+        return len(pings)
+
+    def iterExpiryIndex(self, before):
+        '''
+        A generator of (key, host) for the expiry index entries in the
+        time buckets that end no later than before, in seconds since
+        the epoch. The listing stops at the first later bucket, so it
+        costs no more than the due entries.
+        '''
+        for key, last_modified in self.store.list(EXPIRY_FOLDER):
+            match = EXPIRY_ENTRY_RE.match(key)
+            if not match:
+                continue
+
+            if int(match.group('start')) + EXPIRY_BUCKET_SECONDS > before:
+                break
+
+            yield (key, match.group('host'))
 
     def writeStateFile(self, name, ext, body, ord=None):
-        self.bucket.put_object(
-            Key=getStateFilename(name, ext, ord), Body=body)
+        self.store.put(getStateFilename(name, ext, ord), body)
+
+    def recordFailure(self, name, msg):
+        '''
+        Record a failed request for the specified user or IP, in a new
+        .failures.<ord> file, and return the number of failures within
+        the last FAILURE_WINDOW seconds.
+
+        The failures are counted by listing the name's files, so
+        concurrent failures are all counted without a conditional
+        write. Older failure files are deleted, and the server stops
+        recording failures once the name is locked, so a name has at
+        most about getMaxErrors() of them.
+        '''
+        now = int(time.time())
+
+        self.writeStateFile(
+            name, self.FAILURES_EXT, json.dumps({'error': msg}),
+            ord=now * FAILURE_ORD_SCALE + random.randrange(FAILURE_ORD_SCALE))
+
+        recent = 0
+        old = []
+
+        # List the prefix rather than using the loaded index, which
+        # does not include the file just written.
+        #
+        for f in self.listFiles(
+                getStateFilename(name, self.FAILURES_EXT) + '.'):
+            if not isinstance(f, StateFile) or f.ord is None:
+                continue
+
+            if f.ord // FAILURE_ORD_SCALE > now - FAILURE_WINDOW:
+                recent += 1
+            else:
+                old.append(f.key)
+
+        for key, error in self.deleteKeys(old):
+            logging.getLogger().warning(
+                'Failed to delete {}: {}'.format(key, error))
+
+        return recent
 
     def isLocked(self, name):
-        return getStateFilename(name, self.LOCK_EXT) in self.files
+        return self.hasFile(getStateFilename(name, self.LOCK_EXT))
 
     def getLockFile(self, name):
         return self.getFile(getStateFilename(name, self.LOCK_EXT))
@@ -173,60 +987,241 @@ class S3Bucket():
     def writeLockFile(self, name, msg):
         self.writeStateFile(name, self.LOCK_EXT, json.dumps({'error': msg}))
 
+        def addLock(manifest):
+            manifest['locks'][name.lower()] = {
+                'reason': msg, 'time': int(time.time())}
+
+        self.updateManifest(addLock)
+
     def getUserFile(self, user):
         return self.getFile(getUserFilename(user))
 
+    def readUserFile(self, user):
+        '''
+        Return the content of the user's file, or None if there is no
+        such user. A damaged file reads as empty. This is safe to call
+        from multiple threads.
+        '''
+        try:
+            return self.readFile(getUserFilename(user))
+        except ValueError:
+            return {}
+
     def writeUserFile(self, user, body):
-        self.bucket.put_object(Key=getUserFilename(user), Body=body)
+        '''This is safe to call from multiple threads'''
+        self.store.put(getUserFilename(user), body)
+
+    def readPing(self, hostname):
+        '''
+        Return a Ping for the .ping file of the specified hostname, or
+        None if it has none. This is safe to call from multiple threads.
+        '''
+        found = self.store.get(getStateFilename(hostname, self.PING_EXT))
+        if found is None:
+            return None
+
+        body, etag, last_modified = found
+        content = json.loads(body)
+        return Ping(
+            content.get('ip'), content.get('hold'), last_modified,
+            content.get('entry'))
 
-    def writePingFile(self, hostname, ip, hold):
+    def isFreshPing(self, ping, ip, hold):
+        '''
+        True if the Ping already records ip and hold, and is recent
+        enough that rewriting it can wait. See PING_REFRESH_FRACTION.
+        '''
+        if ping is None or ping.ip != ip or ping.hold != hold:
+            return False
+
+        return toEpoch(ping.last_modified) > \
+            time.time() - getPingRefreshFraction() * Params.MAX_AGE
+
+    def writePingFile(self, hostname, ip, hold, ping=None):
         '''
         Write or update the .ping file for the specified hostname.
         If hold, also write a .hold file for the hostname. Otherwise
         delete any existing .hold file.
+
+        ping is the existing .ping file, as returned by readPing(), if
+        the caller has read it. If it already records ip and hold, and
+        it is recent, nothing is written. Otherwise its expiry index
+        entry is replaced by the new file's. Return True if the files
+        were written.
+
+        The S3 requests for the three files are independent, so they
+        are made concurrently.
         '''
-        self.writeStateFile(
-            hostname, self.PING_EXT, json.dumps({'ip': ip}))
+        hold = bool(hold)
 
-        expired_file = self.getFile(getStateFilename(hostname, 'expired'))
-        if expired_file:
-            expired_file.delete()
+        if self.isFreshPing(ping, ip, hold):
+            return False
 
-        hold_file = self.getFile(getStateFilename(hostname, self.HOLD_EXT))
+        content = {'ip': ip, 'hold': hold}
 
-        if hold:
-            if not hold_file:
-                self.writeStateFile(
-                    hostname, self.HOLD_EXT, json.dumps({'ip': ip}))
-        else:
-            if hold_file:
-                hold_file.delete()
+        # The index entry is in the bucket after the current one, so it
+        # is never earlier than the .ping file's last-modified time, even
+        # though its key is chosen before the file is written. It is
+        # written before the file, so that a failure leaves the old
+        # .ping in place to be rewritten by the next ping, rather than
+        # a fresh .ping that no entry will ever expire. The entry it
+        # supersedes is deleted last. An indexed store finds expired
+        # pings by querying instead.
+        #
+        if not self.store.indexed:
+            content['entry'] = getExpiryEntryKey(
+                hostname, time.time() + EXPIRY_BUCKET_SECONDS)
 
-    def setHostIP(self, host, ip):
+        body = json.dumps(content)
+
+        def writePing():
+            if 'entry' in content:
+                self.store.put(content['entry'], '')
+
+            self.store.put(getStateFilename(hostname, self.PING_EXT), body)
+
+            if 'entry' in content and ping is not None and ping.entry and \
+                    ping.entry != content['entry']:
+                self.store.delete(ping.entry)
+
+        def deleteIfExists(ext):
+            key = getStateFilename(hostname, ext)
+            if self.hasFile(key):
+                self.store.delete(key)
+
+        def updateHold():
+            key = getStateFilename(hostname, self.HOLD_EXT)
+            if not hold:
+                deleteIfExists(self.HOLD_EXT)
+            elif not self.hasFile(key):
+                self.store.put(key, body)
+
+        for _ in iterParallel(
+                lambda task: task(),
+                [writePing, lambda: deleteIfExists(self.EXPIRED_EXT),
+                 updateHold]):
+            pass
+
+        return True
+
+    def makeHostChange(self, host, ip):
         '''
-        Create or update the route 53 A record for the specified hostname.
+        Return a route 53 change that creates or updates
+        the A record for the specified hostname.
+        '''
+        return {
+            'Action': 'UPSERT',
+            'ResourceRecordSet':
+            {
+                'Name': getFullHostname(host),
+                'Type': 'A',
+                'TTL': Params.TTL,
+                'ResourceRecords':
+                    [{'Value': ip if ip else Params.DEFAULT_IP}]
+            }
+        }
+
+    def changeHostIPs(self, host_ips):
         '''
-        result = self.session.client('route53').change_resource_record_sets(
+        Submit one route 53 change batch that creates or updates the
+        A records for a list of (hostname, ip) pairs.
+        '''
+        result = self.getClient('route53').change_resource_record_sets(
             HostedZoneId=Params.ROUTE53_ZONE_ID,
             ChangeBatch={
                 'Changes':
-                    [
-                        {
-                            'Action': 'UPSERT',
-                            'ResourceRecordSet':
-                            {
-                                'Name': getFullHostname(host),
-                                'Type': 'A',
-                                'TTL': Params.TTL,
-                                'ResourceRecords':
-                                    [{'Value':
-                                        ip if ip else Params.DEFAULT_IP}]
-                            }
-                        }
-                    ]
+                    [self.makeHostChange(host, ip) for host, ip in host_ips]
             })
 
         change_info = result.get('ChangeInfo')
         bOk = change_info and 'PENDING' == change_info.get('Status')
 
+        if bOk:
+            for host, ip in host_ips:
+                cacheHostIP(host, ip if ip else Params.DEFAULT_IP)
+
         return (bOk, result)
+
+    def setHostIP(self, host, ip):
+        '''
+        Create or update the route 53 A record for the specified hostname.
+        '''
+        return self.changeHostIPs([(host, ip)])
+
+    def setHostIPs(self, host_ips):
+        '''
+        Create or update the route 53 A records for a list of
+        (hostname, ip) pairs, using as few change batches as
+        route 53 allows.
+
+        A generator that returns a tuple (hosts, ok, result) for each
+        change batch, where result is either the route 53 response or
+        the exception raised by the request. A batch is applied in full
+        or not at all.
+        '''
+        host_ips = list(host_ips)
+
+        for i in range(0, len(host_ips), ROUTE53_MAX_CHANGES):
+            batch = host_ips[i:i + ROUTE53_MAX_CHANGES]
+            hosts = [host for host, ip in batch]
+
+            try:
+                ok, result = self.changeHostIPs(batch)
+            except ClientError as e:
+                ok, result = False, e
+
+            yield (hosts, ok, result)
+
+    def readZoneIP(self, host):
+        '''
+        Return the IP of the specified hostname's A record in the
+        Route 53 zone, or None if it has none. This is safe to call
+        from multiple threads, once the route53 client exists.
+        '''
+        fqdn = getFullHostname(host).lower() + '.'
+        rrsets = self.getClient('route53').list_resource_record_sets(
+            HostedZoneId=Params.ROUTE53_ZONE_ID,
+            StartRecordName=fqdn,
+            StartRecordType='A',
+            MaxItems='1')['ResourceRecordSets']
+
+        if rrsets and rrsets[0]['Name'] == fqdn and \
+                rrsets[0]['Type'] == 'A':
+            return rrsets[0]['ResourceRecords'][0]['Value']
+
+        return None
+
+    def getPingedIP(self, host, ping):
+        '''
+        Return the IP currently assigned to the specified hostname,
+        given its Ping, as returned by readPing(). The Ping's IP is
+        used while the .ping file is too recent to have been expired.
+        If there is no .ping file, or it is older than getExpiryTime(),
+        the expirer may have changed the IP, possibly without removing
+        the file, so the IP is read from the Route 53 zone instead.
+        '''
+        if ping is not None and ping.ip and \
+                ping.last_modified >= getExpiryTime():
+            return ping.ip
+
+        return self.readZoneIP(host)
+
+    def getHostIP(self, host):
+        '''
+        Return the IP currently assigned to the specified hostname, or
+        None if it has none. Consult the in-process cache, and then
+        the hostname's .ping file or the Route 53 zone, as for
+        getPingedIP(), rather than going through (possibly stale)
+        recursive DNS. This is safe to call from multiple threads,
+        once the route53 client exists.
+        '''
+        host = host.lower()
+
+        cached = host_ip_cache.get(host)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        ip = self.getPingedIP(host, self.readPing(host))
+
+        cacheHostIP(host, ip)
+        return ip
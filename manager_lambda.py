@@ -1,23 +1,75 @@
 #!/usr/bin/python
 
 import logging
+import time
+import boto3
 import dynips.managesgs
+from dynips.lib import S3Bucket, startMetrics, instrumentSession
+
+# The time kept back from the end of the invocation, to log
+# the results and emit the metrics
+#
+RESERVED_TIME = 0.25  # seconds
+
+
+def isChangeEvent(event):
+    '''True if the event is an SNS message kicking the manager'''
+    return any(
+        r.get('Sns', {}).get('Message') == '{"Event":"Change"}'
+        for r in event.get('Records', ()))
+
+
+def getDeadline(context):
+    '''
+    Return the time, in epoch seconds, by which the manager must
+    finish, or None if the context does not say.
+    '''
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining is None:
+        return None
+
+    return time.time() + remaining() / 1000.0 - RESERVED_TIME
 
 
 def lambda_handler(event, context):
     '''
-    This is the security grion lambda function.
+    This is the security group lambda function.
+
+    When kicked by a change, it runs only if the pending-change
+    marker is still there, and so the changes it marks have not
+    been applied by a run that was kicked earlier.
     '''
 
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
+    deadline = getDeadline(context)
+    metrics = startMetrics('manager')
+    results = []
+    ok = False
+    skipped = False
+
     try:
-        dynips.managesgs.manageSecurityGroups()
+        session = instrumentSession(boto3.Session())
+
+        if isChangeEvent(event) and \
+                not S3Bucket(session, preload=False).takePending():
+            logger.info('No pending changes')
+            skipped = True
+        else:
+            results = dynips.managesgs.manageSecurityGroups(
+                session, deadline=deadline)
+
+        ok = True
 
     except:
         logging.exception( 'Woops')
 
+    metrics.emit(
+        ok=ok,
+        skipped=skipped,
+        reconciled=len(results),
+        failed=sum(1 for r in results if r.error is not None))
     return {}
 
 
@@ -6,16 +6,66 @@ import re
 import collections
 import socket
 import logging
+import random
+import threading
+import time
+import ipaddress
 import boto3
+from botocore.exceptions import ClientError
 
 from params import Params
 
 HostIp = collections.namedtuple('HostIp', 'host ip')
 PortRange = collections.namedtuple('PortRange', 'begin end protocol')
+ReconcileResult = collections.namedtuple(
+    'ReconcileResult', 'sg seconds removed added error')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# By default, never aggregate CIDRs into a network wider than this.
+# The SG config file can override it with "aggregate_prefix_length".
+# A value of 32 disables aggregation.
+#
+AGGREGATE_PREFIX_LENGTH = 24
+
+# How long to wait for the DNS lookups of the static hosts, and how
+# long to remember their IPs across warm invocations. When the run has
+# a deadline, the lookups get at most DNS_DEADLINE_FRACTION of the time
+# left, so that a dead resolver cannot use up the lambda's short
+# timeout. A host that is not resolved in time keeps its last known IP.
+#
+DNS_TIMEOUT = 1  # seconds
+DNS_DEADLINE_FRACTION = 0.25
+DNS_CACHE_TTL = 300  # seconds
+
+# Maps each static host to a tuple (ip, expiry time)
+#
+resolved_hosts = {}
+
+# Maps each static host to the last IP it resolved to, which is used
+# if a lookup fails, so that a transient failure does not revoke
+# a working rule
+#
+last_good_ips = {}
+
+# The parsed SG config file and its ETag, kept across warm invocations
+#
+sg_config_cache = {}
+
+# How many security groups to reconcile concurrently
+#
+SG_MAX_WORKERS = 8
+
+# How many times to try an EC2 request that is throttled, and the
+# first backoff, which doubles with each retry. The backoffs of one
+# request total at most EC2_BACKOFF_BASE * (2 ** (EC2_MAX_TRIES - 1) - 1)
+# seconds, and no retry is made that would sleep past the run's deadline.
+#
+EC2_MAX_TRIES = 5
+EC2_BACKOFF_BASE = 0.1  # seconds
+EC2_THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling')
+
 
 class Permissions:
     def __init__(self):
@@ -41,6 +91,48 @@ class Permissions:
 
         return False
 
+    def aggregate(self, prefix_length):
+        '''
+        For each port range, remove duplicate CIDRs and collapse
+        overlapping or adjacent ones into as few networks as possible,
+        but no wider than prefix_length. The result grants exactly
+        the same access.
+        '''
+        for range, cidrs in self.map.items():
+            networks = []
+            others = []
+
+            for cidr in cidrs:
+                try:
+                    networks.append(
+                        ipaddress.ip_network(unicode(cidr), strict=False))
+                except ValueError:
+                    others.append(cidr)
+
+            # Networks already wider than prefix_length are kept as
+            # they are. Only narrower ones are merged, up to that width.
+            #
+            wide = list(ipaddress.collapse_addresses(
+                n for n in networks
+                if n.version == 4 and n.prefixlen < prefix_length))
+
+            collapsed = list(wide)
+
+            for n in ipaddress.collapse_addresses(
+                    n for n in networks
+                    if n.version == 4 and n.prefixlen >= prefix_length and
+                    not any(n.network_address in w for w in wide)):
+                if n.prefixlen < prefix_length:
+                    collapsed.extend(n.subnets(new_prefix=prefix_length))
+                else:
+                    collapsed.append(n)
+
+            collapsed.extend(n for n in networks if n.version != 4)
+
+            self.map[range] = dict(
+                (c, False)
+                for c in [str(n) for n in collapsed] + others)
+
     def getUpdates(self, name, id, action):
         r = []
 
@@ -97,6 +189,9 @@ class SG:
     def getUpdates(self, action):
         return self.permissions.getUpdates(self.name, self.id, action)
 
+    def aggregate(self, prefix_length):
+        self.permissions.aggregate(prefix_length)
+
 
 def addHost( sgs, host, cidr, groups):
     for g in groups:
@@ -107,45 +202,262 @@ def addHost( sgs, host, cidr, groups):
                 'Host {} {} references unknown group {}.'.format(host,cidr,g))
 
 
-def manageSecurityGroups(session=None, dry_run=False):
+def parseConfig(text):
     '''
-    Update security groups.
+    Strip comments from the json text of the SG config file and
+    parse it. Report and drop any invalid host definitions.
     '''
-
-    if session is None:
-        session = boto3.Session()
-
-    s3 = session.resource('s3')
-    ec2 = session.client('ec2')
-    ec2_resource = session.resource('ec2')
-    route53 = session.client('route53')
-
-    # Read the SG config file and strip comments from the json text
-    #
-    sg_filename = Params.SG_FILE.split( '/', 1)
-    sg_file = s3.Object( sg_filename[0], sg_filename[1]).get()
-
     json_lines= []
 
-    for line in sg_file['Body'].read().split( '\n'):
+    for line in text.split( '\n'):
         i = line.find( '#')
         if i < 0:
             i = len(line)
         json_lines.append( line[:i])
 
     config = json.loads( ' '.join( json_lines))
+    hosts = []
+
+    for h in config['hosts']:
+        if (not h.get('host') and not h.get('ip')) or not h.get('groups'):
+            print( 'Host definition is invalid: {}'.format( str(h)))
+        else:
+            hosts.append(h)
+
+    config['hosts'] = hosts
+    return config
+
+
+def loadConfig(s3):
+    '''
+    Return the parsed SG config file. The parsed config is cached
+    with the file's ETag, and the file is fetched with a conditional
+    GET, so an unchanged file is neither downloaded nor parsed (nor
+    its errors reported) again.
+    '''
+    sg_filename = Params.SG_FILE.split( '/', 1)
+    kwargs = {}
+
+    if sg_config_cache:
+        kwargs['IfNoneMatch'] = sg_config_cache['etag']
+
+    try:
+        sg_file = s3.get_object(
+            Bucket=sg_filename[0], Key=sg_filename[1], **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return sg_config_cache['config']
+        raise
+
+    config = parseConfig(sg_file['Body'].read())
+
+    sg_config_cache['etag'] = sg_file['ETag']
+    sg_config_cache['config'] = config
+
+    return config
+
+
+def resolveHosts(hosts, timeout=DNS_TIMEOUT):
+    '''
+    Look up the IPs of static hostnames, concurrently and within
+    timeout seconds, and return a dict mapping each host to its IP,
+    or to None if it could not be resolved.
+
+    Answers are cached for DNS_CACHE_TTL seconds. If a lookup fails
+    or times out, the host's last known good IP is used.
+    '''
+    now = time.time()
+    result = {}
+    todo = []
+
+    for host in set(hosts):
+        cached = resolved_hosts.get(host)
+        if cached and cached[1] > now:
+            result[host] = cached[0]
+        else:
+            todo.append(host)
+
+    answers = {}
+
+    def lookup(host):
+        try:
+            answers[host] = socket.gethostbyname(host)
+        except Exception as e:
+            answers[host] = None
+            logger.error( 'Failed to find IP for {}: {}'.format(host, e))
+
+    # gethostbyname has no timeout, so a lookup that is still running
+    # at the deadline is abandoned on its daemon thread.
+    #
+    threads = []
+    for host in todo:
+        t = threading.Thread(target=lookup, args=(host,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    deadline = time.time() + timeout
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+
+    for host in todo:
+        ip = answers.get(host)
+
+        if ip:
+            resolved_hosts[host] = (ip, now + DNS_CACHE_TTL)
+            last_good_ips[host] = ip
+        else:
+            if host not in answers:
+                logger.error( 'Timed out finding IP for {}'.format(host))
+
+            ip = last_good_ips.get(host)
+            if ip:
+                logger.warning(
+                    'Using last known IP {} for {}'.format(ip, host))
+
+        result[host] = ip
+
+    return result
+
+
+def callWithBackoff(func, deadline=None, **kwargs):
+    '''
+    Call an EC2 client method, retrying with exponential
+    backoff while EC2 reports that it is throttling requests.
+    Give up rather than sleep past deadline, in epoch seconds.
+    '''
+    for i in range(EC2_MAX_TRIES):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in EC2_THROTTLING_CODES or \
+                    i == EC2_MAX_TRIES - 1:
+                raise
+
+            delay = random.uniform(0, EC2_BACKOFF_BASE * 2 ** i)
+
+            if deadline is not None and time.time() + delay > deadline:
+                raise
+
+        time.sleep(delay)
+
+
+def countRules(permissions):
+    return sum(len(p['IpRanges']) for p in permissions)
+
+
+def reconcileSG(ec2, sg, dry_run, deadline=None):
+    '''
+    Bring the ingress rules of a security group into line with its
+    desired permissions. The changes are found by comparing these with
+    the group's current rules, as described by describe_security_groups,
+    so a group that is already up to date needs no further EC2 calls.
+    This runs on a worker thread, so it uses only the EC2 client, and
+    returns any exception in the result rather than raising it. A group
+    that has not started by deadline, in epoch seconds, is skipped.
+    '''
+    start = time.time()
+    remove = []
+    add = []
+
+    try:
+        if deadline is not None and start > deadline:
+            raise RuntimeError('Out of time')
+
+        to_remove = Permissions()
+
+        for p in sg.aws_permissions:
+            range = PortRange( p['FromPort'], p['ToPort'], p['IpProtocol'])
+
+            for cidr in (r['CidrIp'] for r in p['IpRanges']):
+                if not sg.hasPermission(range, cidr):
+                    to_remove.addPermission(range, cidr)
+
+        remove = to_remove.getUpdates(sg.name, sg.id, 'remove')
+        add = sg.getUpdates('add')
+
+        if remove and not dry_run:
+            callWithBackoff(
+                ec2.revoke_security_group_ingress, deadline,
+                GroupId=sg.id, IpPermissions=remove)
+
+        if add and not dry_run:
+            callWithBackoff(
+                ec2.authorize_security_group_ingress, deadline,
+                GroupId=sg.id, IpPermissions=add)
+
+        error = None
+
+    except Exception as e:
+        error = e
+
+    return ReconcileResult(
+        sg, time.time() - start, countRules(remove), countRules(add), error)
+
+
+def iterDynipsRecords(route53):
+    '''
+    A generator returning the route 53 record sets at and below
+    the dynips domain root, reading as many pages as needed.
+
+    Route 53 lists the record sets of a zone in order of their
+    reversed labels, so the records below the root follow the root
+    contiguously. The listing starts at the root, and stops at the
+    first record outside it.
+    '''
+    root = Params.DOMAIN_ROOT.lower().rstrip('.') + '.'
+
+    pages = route53.get_paginator('list_resource_record_sets').paginate(
+        HostedZoneId=Params.ROUTE53_ZONE_ID,
+        StartRecordName=root)
+
+    for page in pages:
+        for r in page['ResourceRecordSets']:
+            name = r['Name'].lower()
+
+            if name != root and not name.endswith('.' + root):
+                return
+
+            yield r
+
+
+def manageSecurityGroups(session=None, dry_run=False, deadline=None):
+    '''
+    Update security groups.
+
+    A group whose current rules already match its desired permissions
+    is left alone. Return the ReconcileResults of the groups that were
+    changed, or failed to be.
+
+    deadline is the time, in epoch seconds, by which the run must
+    finish, such as the end of a lambda invocation, or None.
+    '''
+
+    if session is None:
+        session = boto3.Session()
+
+    s3 = session.client('s3')
+    ec2 = session.client('ec2')
+    route53 = session.client('route53')
+
+    with lib.timeStage('load_config'):
+        config = loadConfig(s3)
     sg_defs= config['security_groups']
 
     sgs_by_name = {}
     sgs_by_id = {}
 
-    for aws_sg in ec2.describe_security_groups()['SecurityGroups']:
+    with lib.timeStage('describe_sgs'):
+        aws_sgs = ec2.describe_security_groups()['SecurityGroups']
+
+    for aws_sg in aws_sgs:
         name = aws_sg['GroupName']
         sg_def = sg_defs.get(name)
 
         if sg_def:
             id = aws_sg['GroupId']
             sg = SG(name, id, sg_def.get('ports'))
+            sg.aws_permissions = aws_sg['IpPermissions']
             sgs_by_name[name] = sg
             sgs_by_id[id] = sg
 
@@ -160,13 +472,13 @@ def manageSecurityGroups(session=None, dry_run=False):
     #
     name_map= collections.defaultdict(list)
 
-    rresets = route53.list_resource_record_sets(
-                HostedZoneId=Params.ROUTE53_ZONE_ID)['ResourceRecordSets']
-
     re_expn = '(?P<host>(?P<root>[a-zA-Z0-9]+)(-[a-zA-Z0-9]+)?)\\.{}\\.$'.format(
                     Params.DOMAIN_ROOT.replace('.', '\\.'))
 
-    for r in (r for r in rresets if r['Type']=='A'):
+    with lib.timeStage('list_hosts'):
+        records = list(iterDynipsRecords(route53))
+
+    for r in (r for r in records if r['Type']=='A'):
         match= re.match(re_expn, r['Name'])
         if match:
             ip= r.get('ResourceRecords')[0].get('Value')
@@ -175,63 +487,78 @@ def manageSecurityGroups(session=None, dry_run=False):
                 name_map[match.group('root')].append(
                     HostIp(match.group('host'), ip))
 
+    dns_timeout = DNS_TIMEOUT
+    if deadline is not None:
+        dns_timeout = max(0, min(
+            dns_timeout, (deadline - time.time()) * DNS_DEADLINE_FRACTION))
+
+    with lib.timeStage('resolve_hosts'):
+        static_ips = resolveHosts(
+            (h['host'] for h in config['hosts']
+             if h.get('host') and not h['host'].endswith('*')),
+            dns_timeout)
+
     for h in config['hosts']:
         host = h.get('host')
         cidr = h.get('ip')
         groups = h.get('groups')
 
-        if (not host and not cidr) or not groups:
-            print( 'Host definition is invalid: {}'.format( str(h)))
+        if host:
+            cidr = ''
 
-        else:
-            if host:
-                cidr = ''
-
-                if host.endswith( '*'):
-                    root = host[:-1]
-                    map = name_map.get(root)
-                    if map:
-                        for n in map:
-                            addHost( sgs_by_name, host, n.ip+'/32', groups)
-                    else:
-                        logger.warning(
-                            'Dynip user {} has no hostnames.'.format(root))
+            if host.endswith( '*'):
+                root = host[:-1]
+                map = name_map.get(root)
+                if map:
+                    for n in map:
+                        addHost( sgs_by_name, host, n.ip+'/32', groups)
                 else:
-                    try:
-                        cidr = socket.gethostbyname( host)+'/32'
-                    except:
-                        logger.error( 'Failed to find IP for {}'.format( host))
-
-            # Ignore non-public IPs.
-            # We do this because sometimes Chuck's dyndns IPs are
-            # reported incorrectly to dyndns.
-            #
-            if cidr and (not host or not re.match( '(10\\.)|(192\\.168)', cidr)) :
-                addHost(sgs_by_name, host, cidr, groups)
-
-
-    for id, sg in sgs_by_id.iteritems():
-        try:
-            aws_sg = ec2_resource.SecurityGroup(id)
-
-            to_remove = Permissions()
-
-            for p in aws_sg.ip_permissions:
-                range = PortRange( p['FromPort'], p['ToPort'], p['IpProtocol'])
-
-                for cidr in (r['CidrIp'] for r in p['IpRanges']):
-                    if not sg.hasPermission(range, cidr):
-                        to_remove.addPermission(range, cidr)
-
-            remove = to_remove.getUpdates(sg.name, id, 'remove')
-
-            if remove and not dry_run:
-                aws_sg.revoke_ingress(IpPermissions=remove)
-
-            add = sg.getUpdates('add')
+                    logger.warning(
+                        'Dynip user {} has no hostnames.'.format(root))
+            else:
+                ip = static_ips.get(host)
+                if ip:
+                    cidr = ip+'/32'
+
+        # Ignore non-public IPs.
+        # We do this because sometimes Chuck's dyndns IPs are
+        # reported incorrectly to dyndns.
+        #
+        if cidr and (not host or not re.match( '(10\\.)|(192\\.168)', cidr)) :
+            addHost(sgs_by_name, host, cidr, groups)
+
+    # Shrink the rules, which count against the per-group limit.
+    #
+    prefix_length = config.get(
+        'aggregate_prefix_length', AGGREGATE_PREFIX_LENGTH)
+
+    for sg in sgs_by_id.itervalues():
+        sg.aggregate(prefix_length)
+
+    start = time.time()
+    with lib.timeStage('reconcile'):
+        results = list(lib.iterParallel(
+            lambda sg: reconcileSG(ec2, sg, dry_run, deadline),
+            sgs_by_id.values(),
+            max_workers=SG_MAX_WORKERS))
+
+    changed = []
+
+    for r in sorted(results, key=lambda r: r.sg.name):
+        if r.error is not None:
+            print( 'ERROR: failed to update SG {}: {}'.format(
+                r.sg.id, str(r.error)))
+            changed.append(r)
+        elif r.removed or r.added:
+            logger.info(
+                '{}/{}: {:.2f}s, removed {} rules, added {} rules'.format(
+                    r.sg.name, r.sg.id, r.seconds, r.removed, r.added))
+            changed.append(r)
+        else:
+            logger.info('{}/{}: unchanged'.format(r.sg.name, r.sg.id))
 
-            if add and not dry_run:
-                aws_sg.authorize_ingress(IpPermissions=add)
+    logger.info(
+        'Reconciled {} of {} security groups in {:.2f}s'.format(
+            len(changed), len(sgs_by_id), time.time() - start))
 
-        except Exception as e:
-            print( 'ERROR: failed to update SG {}: {}'.format(id, str(e)))
+    return changed
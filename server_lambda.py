@@ -2,11 +2,16 @@
 
 import logging
 import re
-import json
 import boto3
-import socket
-from passlib.context import CryptContext
+import collections
+import hashlib
+import hmac
+import os
+import time
 from dynips.lib import S3Bucket, getFullHostname, getMaxErrors, kickManager
+from dynips.lib import startMetrics, timeStage, instrumentSession
+from dynips.lib import iterParallel
+from dynips.params import Params
 
 
 class MyException(Exception):
@@ -17,29 +22,201 @@ class MyException(Exception):
         self.record = record
 
 
+class CredentialCache():
+    '''
+    A bounded cache of recently verified credentials. The cache is
+    module-level, so it survives across warm invocations of the lambda,
+    and lets repeat pings with the same correct key skip the PBKDF2
+    verification.
+
+    Entries are keyed on the user, the stored key hash and a keyed
+    digest of the presented key, so a changed user file or a different
+    key always misses and falls through to the real verification.
+    The presented key itself is never stored.
+    '''
+    MAX_ENTRIES = 1000
+    TTL = 900  # seconds
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.secret = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+
+    def makeKey(self, user, hash, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return (
+            user.lower(),
+            hash,
+            hmac.new(self.secret, key, hashlib.sha256).digest())
+
+    def check(self, user, hash, key):
+        '''Return True if the credentials were verified recently'''
+        cache_key = self.makeKey(user, hash, key)
+        expires = self.entries.get(cache_key)
+
+        if expires is not None:
+            if expires > time.time():
+                self.hits += 1
+                return True
+
+            del self.entries[cache_key]
+
+        self.misses += 1
+        return False
+
+    def add(self, user, hash, key):
+        '''Record successfully verified credentials'''
+        now = time.time()
+
+        # Entries are in insertion order, and so in expiry order.
+        #
+        while self.entries and (
+                len(self.entries) >= self.MAX_ENTRIES or
+                next(self.entries.itervalues()) <= now):
+            self.entries.popitem(last=False)
+
+        self.entries[self.makeKey(user, hash, key)] = now + self.TTL
+
+
+credential_cache = CredentialCache()
+crypt_context = None
+
+# The boto3 session and S3Bucket used by the handler. They are created
+# on the first request and reused by later requests to the same
+# container, along with the clients they create, so that only a cold
+# start pays for them. The benchmark script substitutes a session of
+# in-process stand-ins.
+#
+session = None
+s3_bucket = None
+
+
+def getBucket():
+    '''
+    Return the S3Bucket for the container, creating it on first use.
+    The bucket does not preload the state files, so it holds no state
+    that could go stale between requests.
+    '''
+    global session, s3_bucket
+
+    if s3_bucket is None:
+        if session is None:
+            session = instrumentSession(boto3.Session())
+
+        s3_bucket = S3Bucket(session, preload=False)
+
+        # Creating clients is not thread-safe, so create those that
+        # requests use from multiple threads up front.
+        #
+        s3_bucket.getClient('route53')
+
+        if Params.DO_SNS:
+            s3_bucket.getClient('sns')
+
+    return s3_bucket
+
+
+def verifyKey(user, key, hash):
+    '''
+    Verify a key against the hash from a user file,
+    consulting the credential cache first.
+    '''
+    global crypt_context
+
+    if credential_cache.check(user, hash, key):
+        return True
+
+    # passlib is imported here, rather than at the top, so that
+    # requests without a key never pay for it.
+    #
+    if crypt_context is None:
+        from passlib.context import CryptContext
+        crypt_context = CryptContext(schemes=['pbkdf2_sha256'])
+
+    if not crypt_context.verify(key, hash):
+        return False
+
+    credential_cache.add(user, hash, key)
+    return True
+
+
+def lookUp(bucket, client_ip, host, read_ping):
+    '''
+    Make the independent lookups that a request needs, concurrently,
+    and return a dict of their results:
+
+    ip_locked: True if the client IP is locked
+    user_locked: True if the user is locked
+    user_data: The content of the user file, or None if there is none
+    cur_ip: The host's current IP, or 'unknown'
+    ping: If read_ping, the host's Ping, or None if it has none
+
+    Only ip_locked is present unless host is given, and the results
+    may be incomplete once a lock is found, since a lock decides the
+    request. The lookups still running are abandoned.
+
+    If read_ping, the current IP is taken from the Ping, or from
+    Route 53 if the Ping is missing or old, by getPingedIP(). It may
+    decide a change to Route 53, so the in-process cache, which can
+    be out of date, is not used. Otherwise, getHostIP() looks the IP
+    up, through the cache.
+    '''
+    def getHostIP():
+        ping = None
+        try:
+            if read_ping:
+                ping = bucket.readPing(host)
+                ip = bucket.getPingedIP(host, ping)
+            else:
+                ip = bucket.getHostIP(host)
+        except Exception as e:
+            logging.getLogger().error(
+                'Error looking up {}: {}'.format(host, str(e)))
+            ip = None
+
+        return {'ping': ping, 'cur_ip': ip or 'unknown'}
+
+    lookups = [lambda: {'ip_locked': bucket.isLocked(client_ip)}]
+
+    if host:
+        user = host.split('-', 1)[0]
+        lookups.extend([
+            lambda: {'user_locked': bucket.isLocked(user)},
+            lambda: {'user_data': bucket.readUserFile(user)},
+            getHostIP,
+        ])
+
+    found = {}
+
+    for values in iterParallel(lambda lookup: lookup(), lookups):
+        found.update(values)
+
+        if values.get('ip_locked') or values.get('user_locked'):
+            break
+
+    return found
+
+
 def recordError(bucket, name, msg):
     '''
     Record the fact that an error occurred for the specifed
     name, which is either a username or an IP address. We do this
-    by creating a file with the name <name>.ERROR.<ord>, where <ord>
-    is the next higest ordinal for the given name.
+    by creating a file with the name <name>.FAILURES.<ord>, where
+    <ord> encodes the time of the error. Only the errors of the last
+    FAILURE_WINDOW seconds are counted.
 
-    If the number of ERROR files reaches MAX_ERRORS, we lock the
+    If the number of recent errors reaches MAX_ERRORS, we lock the
     user or IP by writing the file <name>.LOCK.
     '''
+    with timeStage('record_error'):
+        count = bucket.recordFailure(name, msg)
 
-    ords = [f.ord
-                for f in bucket.iterStateFiles(base=name, ext=bucket.ERROR_EXT)
-            if f.ord is not None]
-
-    bucket.writeStateFile(
-        name,
-        bucket.ERROR_EXT,
-        json.dumps({'error': msg}),
-        ord=(max(ords) if ords else 0) + 1)
-
-    if len(ords) + 1 >= getMaxErrors():
-        bucket.writeLockFile(name, msg)
+    if count >= getMaxErrors():
+        with timeStage('record_error'):
+            bucket.writeLockFile(name, msg)
 
 
 def lambda_handler(event, context):
@@ -59,10 +236,14 @@ def lambda_handler(event, context):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
+    metrics = startMetrics('server')
+    status = 200
+
     result = {}
 
     bucket = None
     user = None
+    ping_written = False
     client_ip = event['remote_addr']
 
     key = event.get('key')
@@ -73,53 +254,57 @@ def lambda_handler(event, context):
     logger.info('Request: {}'.format( str(event)))
 
     try:
-        bucket = S3Bucket()
+        with timeStage('init'):
+            bucket = getBucket()
+
+        host = event.get('host')
+        host_match = host and re.match(
+            '(([a-zA-Z0-9]+)(-[a-zA-Z0-9]+)?)$', host)
 
-        if bucket.isLocked(client_ip):
+        with timeStage('lookups'):
+            found = lookUp(
+                bucket, client_ip, host_match and host_match.group(1),
+                bool(key))
+
+        if found.get('ip_locked'):
             raise MyException(
                 401, False, "IP '{}' is locked".format(client_ip))
 
         result['ip'] = client_ip
 
-        host = event.get('host')
         if host:
-            host_match = re.match('(([a-zA-Z0-9]+)(-[a-zA-Z0-9]+)?)$', host)
-
             if not host_match:
                 raise MyException(
                     400, False, "Invalid host param '{}'".format(host))
 
             user = host_match.group(2)
 
-            if bucket.isLocked(user):
+            if found.get('user_locked'):
                 raise MyException(
                     401, False, "User '{}' is locked".format(user))
 
-            user_file = bucket.getUserFile(user)
+            user_data = found['user_data']
 
-            if not user_file:
+            if user_data is None:
                 raise MyException(
                     401, True, "Unknown user '{}'".format(user))
 
-            fqdn = getFullHostname(host)
-
-            try:
-                cur_ip = socket.gethostbyname(fqdn)
-            except Exception as e:
-                logger.error('Error looking up {}: {}'.format(fqdn, str(e)))
-                cur_ip = 'unknown'
+            cur_ip = found['cur_ip']
 
             if key:
-                user_data = json.load(user_file.get()['Body'])
-
                 hash = user_data.get( 'keyhash')
                 if not hash:
                     raise MyException(
                         500, False, 'The user configuration is damaged')
 
-                if not CryptContext(
-                        schemes=['pbkdf2_sha256']).verify(key, hash):
+                with timeStage('verify_key'):
+                    verified = verifyKey(user, key, hash)
+
+                logger.info(
+                    'Credential cache: {} hits, {} misses'.format(
+                        credential_cache.hits, credential_cache.misses))
 
+                if not verified:
                     raise MyException(
                         401, True,
                         "Unknown user '{}' or invalid key '****'".format(
@@ -134,13 +319,17 @@ def lambda_handler(event, context):
                 else:
                     new_ip = client_ip
 
+                # The Route 53 change is made first, so that a failed
+                # change leaves the ping file, and so the IP that the
+                # next ping compares against, as it was.
+                #
                 if cur_ip != new_ip:
                     action = 'updated'
                     result['new_ip'] = new_ip
-                    ok, commit_result = bucket.setHostIP(host, new_ip)
+                    with timeStage('route53'):
+                        ok, commit_result = bucket.setHostIP(host, new_ip)
 
                     if ok:
-                        kickManager(bucket.session)
                         logger.info(
                             'Route53 result: {}'.format( str(commit_result)))
                     else:
@@ -152,7 +341,17 @@ def lambda_handler(event, context):
                     action = 'no_change'
 
                 result['action'] = action
-                bucket.writePingFile(host, new_ip, event.get('expire') == 'no')
+                with timeStage('ping_file'):
+                    ping_written = bucket.writePingFile(
+                        host, new_ip, event.get('expire') == 'no',
+                        found.get('ping'))
+
+                # The manager reads the IPs from Route 53, which was
+                # updated above, so the kick cannot miss this change.
+                #
+                if action == 'updated':
+                    with timeStage('kick_manager'):
+                        kickManager(bucket)
 
             # Set these after validating user credentials
             # so that we don't reveal information if the
@@ -163,6 +362,7 @@ def lambda_handler(event, context):
 
     except MyException as e:
         logger.error(e.msg)
+        status = e.code
 
         if e.record and bucket is not None:
             recordError(bucket, client_ip, e.msg)
@@ -178,8 +378,17 @@ def lambda_handler(event, context):
 
     except:
         logging.exception( 'Woops')
+        status = 500
         raise Exception('500: Internal error')
 
+    finally:
+        metrics.emit(
+            status=status,
+            action=result.get('action'),
+            ping_written=ping_written,
+            credential_cache_hits=credential_cache.hits,
+            credential_cache_misses=credential_cache.misses)
+
     logger.info('Result: {}'.format( result))
     return result
 
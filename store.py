@@ -0,0 +1,329 @@
+import sqlite3
+import calendar
+import hashlib
+import datetime
+import threading
+import time
+from StringIO import StringIO
+
+import pytz
+from botocore.exceptions import ClientError
+
+
+'''
+The storage backends for S3Bucket. A store holds files by key, as S3
+does, and has these methods:
+
+Object(key)     Return an object for the file, with the get(), put()
+                and delete() methods and last_modified attribute of
+                an S3 Object
+list(prefix)    A generator of (key, last_modified) for the files whose
+                keys start with prefix, in key order
+head(key)       Return (etag, last_modified), or None if there is no file
+get(key)        Return (body, etag, last_modified), or None
+put(key, body)   Write a file
+delete(key)     Delete a file, if it exists
+deleteMany(keys, progress=None)
+                Delete files, and return a list of (key, message) for
+                those that could not be deleted. If given, call
+                progress(done, total) as batches of keys complete.
+copy(src, dst)  Copy a file
+
+A store whose indexed attribute is True also has these methods, which
+S3Bucket uses instead of listing files:
+
+queryState(items, exts, user, before)
+                A generator of (key, last_modified) for the state files
+                with any of the items, any of the exts, the user, and
+                last modified before the datetime before, each if given
+queryUsers()    A generator of (key, last_modified) for the user files
+
+last_modified is a timezone-aware datetime. All the methods are safe
+to call from multiple threads, except for the S3 store's Object().
+'''
+
+
+def makeEtag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+# The most keys S3 accepts in one delete_objects request
+#
+S3_MAX_DELETE_KEYS = 1000
+
+
+class S3Store(object):
+    '''
+    Files in an S3 bucket, accessed through the bucket's client,
+    which boto3 makes thread-safe, or for Object(), its resource.
+    '''
+    indexed = False
+
+    def __init__(self, session, bucket_name, iter_parallel):
+        '''
+        iter_parallel is lib.iterParallel, which is passed in
+        because lib imports this module.
+        '''
+        self.s3 = session.resource('s3')
+        self.bucket = self.s3.Bucket(bucket_name)
+        self.client = self.s3.meta.client
+        self.name = bucket_name
+        self.iter_parallel = iter_parallel
+
+    def Object(self, key):
+        return self.bucket.Object(key)
+
+    def list(self, prefix=None):
+        if prefix:
+            summaries = self.bucket.objects.filter(Prefix=prefix)
+        else:
+            summaries = self.bucket.objects.all()
+
+        for s in summaries:
+            yield (s.key, s.last_modified)
+
+    def head(self, key):
+        try:
+            result = self.client.head_object(Bucket=self.name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return None
+
+        return (result['ETag'], result['LastModified'])
+
+    def get(self, key):
+        try:
+            result = self.client.get_object(Bucket=self.name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return None
+
+        return (result['Body'].read(), result['ETag'], result['LastModified'])
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=self.name, Key=key, Body=body)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.name, Key=key)
+
+    def deleteMany(self, keys, progress=None):
+        '''
+        Delete the keys with concurrent delete_objects
+        requests of up to S3_MAX_DELETE_KEYS keys each.
+        '''
+        keys = list(keys)
+
+        def deleteBatch(batch):
+            try:
+                result = self.client.delete_objects(
+                    Bucket=self.name,
+                    Delete={
+                        'Objects': [{'Key': k} for k in batch],
+                        'Quiet': True
+                    })
+            except ClientError as e:
+                return (batch, [(k, str(e)) for k in batch])
+
+            return (batch, [(err['Key'], err.get('Message', err.get('Code')))
+                            for err in result.get('Errors', ())])
+
+        failed = []
+        done = 0
+
+        for batch, errors in self.iter_parallel(
+                deleteBatch,
+                (keys[i:i + S3_MAX_DELETE_KEYS]
+                 for i in range(0, len(keys), S3_MAX_DELETE_KEYS))):
+            failed.extend(errors)
+            done += len(batch)
+            if progress:
+                progress(done, len(keys))
+
+        return failed
+
+    def copy(self, src, dst):
+        self.client.copy_object(
+            Bucket=self.name, Key=dst,
+            CopySource={'Bucket': self.name, 'Key': src})
+
+
+class SQLiteObject(object):
+    '''The subset of the S3 Object interface that dynips uses'''
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    @property
+    def last_modified(self):
+        found = self.store.head(self.key)
+        return found[1] if found else None
+
+    def get(self):
+        found = self.store.get(self.key)
+        if found is None:
+            raise ClientError(
+                {'Error': {'Code': 'NoSuchKey', 'Message': self.key}},
+                'GetObject')
+
+        body, etag, last_modified = found
+        return {'Body': StringIO(body), 'ETag': etag,
+                'LastModified': last_modified}
+
+    def put(self, Body):
+        self.store.put(self.key, Body)
+
+    def delete(self):
+        self.store.delete(self.key)
+
+
+class SQLiteStore(object):
+    '''
+    Files in an SQLite database, with indexes on the item and extension,
+    the user, and the last-modified time of the state files, so that
+    lookups are queries rather than listings. The database may be
+    shared by several processes on one host.
+
+    index_key is a function that returns the (item, ext, user) of a
+    key, any of which may be None.
+    '''
+    indexed = True
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            key TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            etag TEXT NOT NULL,
+            last_modified REAL NOT NULL,
+            item TEXT,
+            ext TEXT,
+            user TEXT);
+        CREATE INDEX IF NOT EXISTS files_item_ext ON files (item, ext);
+        CREATE INDEX IF NOT EXISTS files_user ON files (user);
+        CREATE INDEX IF NOT EXISTS files_last_modified
+            ON files (ext, last_modified);
+    '''
+
+    def __init__(self, path, index_key):
+        self.path = path
+        self.index_key = index_key
+        self.local = threading.local()
+
+        self.connect().executescript(self.SCHEMA)
+
+    def connect(self):
+        '''Return the calling thread's connection'''
+        db = getattr(self.local, 'db', None)
+
+        if db is None:
+            db = self.local.db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+
+        return db
+
+    @staticmethod
+    def toDatetime(epoch):
+        return datetime.datetime.fromtimestamp(epoch, pytz.UTC)
+
+    def Object(self, key):
+        return SQLiteObject(self, key)
+
+    def iterRows(self, sql, params=()):
+        for key, last_modified in self.connect().execute(sql, params):
+            yield (key, self.toDatetime(last_modified))
+
+    def list(self, prefix=None):
+        if not prefix:
+            return self.iterRows(
+                'SELECT key, last_modified FROM files ORDER BY key')
+
+        # The range of keys that start with prefix
+        #
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return self.iterRows(
+            'SELECT key, last_modified FROM files '
+            'WHERE key >= ? AND key < ? ORDER BY key', (prefix, end))
+
+    def queryState(self, items=(), exts=(), user=None, before=None):
+        where = ['ext IS NOT NULL']
+        params = []
+
+        for column, values in (('item', items), ('ext', exts)):
+            if values:
+                where.append('{} IN ({})'.format(
+                    column, ','.join('?' * len(values))))
+                params.extend(values)
+
+        if user:
+            where.append('user = ?')
+            params.append(user)
+
+        if before is not None:
+            where.append('last_modified < ?')
+            params.append(calendar.timegm(before.utctimetuple()))
+
+        return self.iterRows(
+            'SELECT key, last_modified FROM files WHERE {} ORDER BY key'
+            .format(' AND '.join(where)), params)
+
+    def queryUsers(self):
+        return self.iterRows(
+            'SELECT key, last_modified FROM files '
+            'WHERE ext IS NULL AND user IS NOT NULL ORDER BY key')
+
+    def head(self, key):
+        row = self.connect().execute(
+            'SELECT etag, last_modified FROM files WHERE key = ?',
+            (key,)).fetchone()
+
+        return (row[0], self.toDatetime(row[1])) if row else None
+
+    def get(self, key):
+        row = self.connect().execute(
+            'SELECT body, etag, last_modified FROM files WHERE key = ?',
+            (key,)).fetchone()
+
+        return (str(row[0]), row[1], self.toDatetime(row[2])) if row else None
+
+    def put(self, key, body):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        item, ext, user = self.index_key(key)
+
+        self.connect().execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, sqlite3.Binary(body), makeEtag(body), time.time(),
+             item, ext, user))
+
+    def delete(self, key):
+        self.connect().execute('DELETE FROM files WHERE key = ?', (key,))
+
+    def deleteMany(self, keys, progress=None):
+        keys = list(keys)
+        db = self.connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'DELETE FROM files WHERE key = ?', ((k,) for k in keys))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+        if progress:
+            progress(len(keys), len(keys))
+
+        return []
+
+    def copy(self, src, dst):
+        found = self.get(src)
+        if found is None:
+            raise ClientError(
+                {'Error': {'Code': 'NoSuchKey', 'Message': src}},
+                'CopyObject')
+
+        self.put(dst, found[0])